@@ -0,0 +1,79 @@
+"""
+Micro-benchmark for `BaseModelSerializer` instantiation with and without
+the per-class `get_fields()` cache.
+
+Usage: python development/benchmark_serializer_fields.py [iterations]
+"""
+import os
+import sys
+import timeit
+
+import django
+from django.conf import settings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+settings.configure(
+    DEBUG=False,
+    USE_TZ=True,
+    TIME_ZONE="UTC",
+    LOCAL_TIME_ZONE="Asia/Kolkata",
+    INSTALLED_APPS=[
+        "django.contrib.contenttypes",
+        "django.contrib.auth",
+        "rest_framework",
+        "cities_light",
+        "smart_selects",
+    ],
+    DATABASES={"default": {"ENGINE": "django.db.backends.sqlite3", "NAME": ":memory:"}},
+)
+django.setup()
+
+from django.contrib.auth.models import Group, Permission, User  # noqa: E402
+
+from pyutils.django.serializers import BaseModelSerializer  # noqa: E402
+
+
+class PermissionSerializer(BaseModelSerializer):
+    class Meta:
+        model = Permission
+        fields = "__all__"
+
+
+class GroupSerializer(BaseModelSerializer):
+    permissions = PermissionSerializer(many=True)
+
+    class Meta:
+        model = Group
+        fields = "__all__"
+
+
+class UserSerializer(BaseModelSerializer):
+    groups = GroupSerializer(many=True)
+
+    class Meta:
+        model = User
+        exclude = ["password"]
+
+
+def instantiate():
+    # accessing `.fields` is what triggers `get_fields()`
+    UserSerializer().fields
+    UserSerializer(many=True).child.fields
+    GroupSerializer().fields["permissions"].child.fields
+
+
+def run(cache_fields, number):
+    BaseModelSerializer.cache_fields = cache_fields
+    instantiate()  # warm up
+    seconds = min(timeit.repeat(instantiate, number=number, repeat=5))
+    return seconds / number * 1e6
+
+
+if __name__ == "__main__":
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    before = run(False, number)
+    after = run(True, number)
+    print("get_fields() uncached: {:.1f}us per iteration".format(before))
+    print("get_fields() cached:   {:.1f}us per iteration".format(after))
+    print("speedup: {:.2f}x".format(before / after))
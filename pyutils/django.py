@@ -2,16 +2,25 @@
 Django Utils
 """
 import abc
+import hashlib
+import json
 import logging
-from typing import Dict, Tuple
+import multiprocessing
+import queue as queue_module
+import time
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
 
 import jwt
 from django.conf import settings
-from django.db import models
-from django.db.models import Model
+from django.core.exceptions import ValidationError
+from django.db import connections, models
+from django.db.models import Model, Q
 from django.template.defaultfilters import truncatechars
+from django.utils import timezone
 from jsonpath_ng import parse
+from model_utils.fields import AutoLastModifiedField
 
+from .json import JsonStreamReader, iter_json_array
 from .string import pascal_case_to_dash_case, pascal_case_to_underscore_case
 
 logger = logging.getLogger(__name__)
@@ -122,18 +131,66 @@ def update_model_from_dict(model_obj: Model, data: Dict):
     model_obj.save()
 
 
+def row_fingerprint(data: Dict) -> str:
+    """
+    Content hash of a mapped row.
+    """
+    content = json.dumps(data, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+class MapperPlan(NamedTuple):
+    json_paths: List[Tuple[str, object]]  # (json_path, compiled expression)
+    # (key, field_name, proc_func), None when rows use `get_updated_data_dict`
+    field_mapping: Optional[Tuple[Tuple[str, str, Optional[Callable]], ...]]
+
+
+_mapper_plans: Dict[type, MapperPlan] = {}
+
+
 class ModelDataMapper(abc.ABC):
+    """
+    Maps JSON rows to model instances.
+
+    By default every row is loaded with `get_or_create` and saved.
+    With `upsert = True` rows are mapped first and written in batches of
+    `batch_size` with `bulk_create(update_conflicts=True)` on
+    `upsert_unique_fields`, updating `upsert_update_fields` (all the mapped
+    fields except the unique ones if unset). `after_update` runs for each
+    instance of a batch before it is written, via `after_update_batch`.
+
+    `json_paths` and `field_mapping` are compiled once per class (see
+    `get_plan`), so they should not be changed after the first instance.
+
+    Set `fingerprint_field` (a `CharField(max_length=40)` on the model) to
+    skip unchanged rows: a hash of each mapped row is stored in it, and
+    rows whose hash matches the stored one for their `natural_key_fields`
+    (`upsert_unique_fields` if unset) are skipped. The stored hashes are
+    looked up once per batch of `batch_size` rows. `skipped_rows` counts
+    the skipped rows.
+    """
+
     model: Model = None
     field_mapping = {}  # ('field_name','proc_func')
     json_paths = []
-
-    def __init__(self, data: Dict):
+    upsert = False
+    upsert_unique_fields = []
+    upsert_update_fields = None
+    batch_size = 1000
+    fingerprint_field = None
+    natural_key_fields = []
+
+    def __init__(self, data: Dict = None, stream=None):
         self.model_obj = None
         self.data = data
         self.rows = []
-        if self.json_paths:
-            for json_path in self.json_paths:
-                jsonpath_expr = parse(json_path)
+        if stream is not None:
+            self.rows = self._iter_stream_rows(stream)
+        elif data is None:
+            # no document, eg a mapper used only to `write_mapped` rows
+            pass
+        elif self.json_paths:
+            for json_path, jsonpath_expr in self.get_plan().json_paths:
                 data_list = [match.value for match in jsonpath_expr.find(data)]
                 if not isinstance(data_list, list):
                     raise ValueError("json_path should return a list")
@@ -146,6 +203,77 @@ class ModelDataMapper(abc.ABC):
             ]
 
         self.updated_data = {}
+        self.skipped_rows = 0
+
+    @classmethod
+    def from_stream(cls, stream):
+        """
+        Read the rows incrementally from a JSON file object (text or binary)
+        or an iterator of bytes, instead of a parsed document.
+
+        `self.rows` is then a generator, so memory stays bounded by a batch
+        of rows. `json_paths` must be simple key paths to the arrays, eg
+        `$.data.items` (the same form as for a parsed document); several
+        paths need a seekable file, which is re-read for each path.
+        """
+        return cls(stream=stream)
+
+    def _iter_stream_rows(self, stream):
+        if not self.json_paths:
+            yield JsonStreamReader(stream).decode()
+            return
+        for n, json_path in enumerate(self.json_paths):
+            if n:
+                if not hasattr(stream, "seek"):
+                    raise ValueError(
+                        "Streaming several json_paths needs a seekable file"
+                    )
+                stream.seek(0)
+            for item in iter_json_array(stream, json_path):
+                item["_json_path"] = json_path
+                yield item
+
+    @classmethod
+    def get_plan(cls) -> MapperPlan:
+        """
+        The compiled `json_paths` and `field_mapping` of the class.
+        """
+        try:
+            return _mapper_plans[cls]
+        except KeyError:
+            pass
+        json_paths = [(json_path, parse(json_path)) for json_path in cls.json_paths]
+        field_mapping = tuple(
+            (key, field_name, proc_func)
+            for key, (field_name, proc_func) in cls.field_mapping.items()
+        )
+        field_names = [field_name for _, field_name, _ in field_mapping]
+        if (
+            len(set(field_names)) != len(field_names)
+            or cls.get_updated_data_dict
+            is not ModelDataMapper.get_updated_data_dict
+        ):
+            # several keys map to the same field (the first key in the row
+            # wins) or the mapping is customised: map the rows as before
+            field_mapping = None
+        plan = _mapper_plans[cls] = MapperPlan(json_paths, field_mapping)
+        return plan
+
+    def map_row(self, row: Dict) -> Dict:
+        """
+        Map a row to a dict of field_name => value.
+        Same as `get_updated_data_dict(row, self.field_mapping)`, but only
+        the mapped keys are looked up.
+        """
+        field_mapping = self.get_plan().field_mapping
+        if field_mapping is None:
+            return self.get_updated_data_dict(row, self.field_mapping)
+        updated_data = {}
+        for key, field_name, proc_func in field_mapping:
+            if key in row:
+                val = row[key]
+                updated_data[field_name] = proc_func(val) if proc_func else val
+        return updated_data
 
     def update_model_kwargs(self, kwargs):
         """
@@ -165,16 +293,150 @@ class ModelDataMapper(abc.ABC):
         """
         if not self.is_applicable():
             return
-        for row in self.rows:
-            self._update(row)
+        if not (self.upsert or self.fingerprint_field):
+            for row in self.rows:
+                self._update(row)
+            return
+        self.write_mapped(self.map_row(row) for row in self.rows)
+
+    def write_mapped(self, mapped_rows: Iterable[Dict]):
+        """
+        Write rows that are already mapped (dicts of field_name => value),
+        eg by `map_row` in another process.
+        """
+        if self.fingerprint_field:
+            mapped_rows = self._changed_rows(mapped_rows)
+        else:
+            mapped_rows = ((updated_data, None) for updated_data in mapped_rows)
+        if self.upsert:
+            self._upsert(mapped_rows)
+            return
+        for updated_data, fingerprint in mapped_rows:
+            self._update_mapped(updated_data, fingerprint)
 
     def _update(self, row):
-        self.updated_data = self.get_updated_data_dict(row, self.field_mapping)
+        self._update_mapped(self.map_row(row))
+
+    def _update_mapped(self, updated_data, fingerprint=None):
+        self.updated_data = updated_data
         kwargs = self.update_model_kwargs(self.updated_data)
         self.load_model_obj(kwargs)
+        if fingerprint:
+            setattr(self.model_obj, self.fingerprint_field, fingerprint)
         self.after_update()
         self.model_obj.save()
 
+    def _upsert(self, mapped_rows):
+        batch = []
+        for updated_data, fingerprint in mapped_rows:
+            kwargs = self.update_model_kwargs(updated_data)
+            model_obj = self.model(**kwargs)
+            if fingerprint:
+                setattr(model_obj, self.fingerprint_field, fingerprint)
+            batch.append((model_obj, updated_data, kwargs.keys()))
+            if len(batch) >= self.batch_size:
+                self._write_batch(batch)
+                batch = []
+        if batch:
+            self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        model_objs = [model_obj for model_obj, _, _ in batch]
+        self.after_update_batch(model_objs, [data for _, data, _ in batch])
+        update_fields = self.upsert_update_fields
+        if update_fields is None:
+            opts = self.model._meta
+            mapped_fields = {
+                opts.get_field(key).name for _, _, keys in batch for key in keys
+            }
+            update_fields = sorted(mapped_fields - set(self.upsert_unique_fields))
+        if self.fingerprint_field and self.fingerprint_field not in update_fields:
+            update_fields = [*update_fields, self.fingerprint_field]
+        # `modified` (auto_now) fields are set on update as `save()` would
+        auto_updated = [
+            field
+            for field in self.model._meta.concrete_fields
+            if getattr(field, "auto_now", False)
+            or isinstance(field, AutoLastModifiedField)
+        ]
+        if auto_updated:
+            now = timezone.now()
+            for model_obj in model_objs:
+                for field in auto_updated:
+                    setattr(model_obj, field.attname, now)
+            update_fields = [
+                *update_fields,
+                *(f.name for f in auto_updated if f.name not in update_fields),
+            ]
+        if not update_fields:
+            # only the unique fields are mapped, existing rows are left as is
+            self.model.objects.bulk_create(
+                model_objs, batch_size=self.batch_size, ignore_conflicts=True
+            )
+            return
+        self.model.objects.bulk_create(
+            model_objs,
+            batch_size=self.batch_size,
+            update_conflicts=True,
+            unique_fields=self.upsert_unique_fields,
+            update_fields=update_fields,
+        )
+
+    def _changed_rows(self, mapped_rows):
+        """
+        Yield (updated_data, fingerprint) of the rows whose fingerprint
+        differs from the stored one, with one lookup per batch.
+        """
+        batch = []
+        for updated_data in mapped_rows:
+            batch.append(updated_data)
+            if len(batch) >= self.batch_size:
+                yield from self._skip_unchanged(batch)
+                batch = []
+        if batch:
+            yield from self._skip_unchanged(batch)
+
+    def _skip_unchanged(self, batch):
+        keys = [self._natural_key(updated_data) for updated_data in batch]
+        stored = self._stored_fingerprints(keys)
+        for updated_data, key in zip(batch, keys):
+            fingerprint = row_fingerprint(updated_data)
+            if stored.get(key) == fingerprint:
+                self.skipped_rows += 1
+                continue
+            yield updated_data, fingerprint
+
+    def _natural_key_fields(self):
+        return self.natural_key_fields or self.upsert_unique_fields
+
+    def _natural_key(self, updated_data):
+        opts = self.model._meta
+        key = []
+        for field_name in self._natural_key_fields():
+            value = updated_data.get(field_name)
+            try:
+                value = opts.get_field(field_name).to_python(value)
+            except ValidationError:
+                pass
+            key.append(value)
+        return tuple(key)
+
+    def _stored_fingerprints(self, keys):
+        """
+        Dict of natural key => stored fingerprint for the given keys.
+        """
+        fields = self._natural_key_fields()
+        if len(fields) == 1:
+            query = Q(**{f"{fields[0]}__in": {key[0] for key in keys}})
+        else:
+            query = Q()
+            for key in set(keys):
+                query |= Q(**dict(zip(fields, key)))
+        rows = self.model.objects.filter(query).values_list(
+            *fields, self.fingerprint_field
+        )
+        return {tuple(row[:-1]): row[-1] for row in rows}
+
     def after_update(self):
         """
         Use this as a hook.
@@ -182,6 +444,16 @@ class ModelDataMapper(abc.ABC):
         """
         return
 
+    def after_update_batch(self, model_objs: List[Model], updated_data: List[Dict]):
+        """
+        Batch form of `after_update`, called in upsert mode before a batch
+        is written. Runs `after_update` for every instance by default.
+        """
+        for model_obj, data in zip(model_objs, updated_data):
+            self.model_obj = model_obj
+            self.updated_data = data
+            self.after_update()
+
     @staticmethod
     def get_updated_data_dict(data: Dict, field_mapping: Dict):
         """
@@ -203,3 +475,169 @@ class ModelDataMapper(abc.ABC):
         If tests is applicable
         """
         return True
+
+
+def _map_documents(mapper_class, paths_queue, rows_queue, batch_size, stream):
+    """
+    Pipeline worker: parse and map documents until a `None` path is read.
+    """
+    try:
+        while True:
+            path = paths_queue.get()
+            if path is None:
+                return
+            start = time.monotonic()
+            n = 0
+            try:
+                with open(path, "rb") as f:
+                    if stream:
+                        mapper = mapper_class.from_stream(f)
+                    else:
+                        mapper = mapper_class(json.load(f))
+                    if not mapper.is_applicable():
+                        continue
+                    batch = []
+                    for row in mapper.rows:
+                        batch.append(mapper.map_row(row))
+                        if len(batch) >= batch_size:
+                            rows_queue.put(("rows", batch))
+                            n += len(batch)
+                            batch = []
+                    if batch:
+                        rows_queue.put(("rows", batch))
+                        n += len(batch)
+            except Exception as e:
+                logger.exception("Could not map %s", path)
+                rows_queue.put(("error", path, repr(e)))
+                continue
+            rows_queue.put(("document", path, n, time.monotonic() - start))
+    finally:
+        connections.close_all()
+        rows_queue.put(("done",))
+
+
+class ModelDataMapperPipeline:
+    """
+    Ingest a set of JSON documents with a `ModelDataMapper` class.
+
+    Documents are parsed and mapped in `workers` processes, which send
+    batches of mapped rows to a single writer (the calling process) that
+    writes them with `mapper_class.write_mapped`, ie in batches when the
+    mapper uses `upsert` or `fingerprint_field`. At most `queue_size`
+    batches are in flight, so parsing waits when the writer falls behind.
+
+    Usage:
+        stats = ModelDataMapperPipeline(MyMapper, paths, workers=8).run()
+    """
+
+    def __init__(
+        self,
+        mapper_class: type,
+        paths: Iterable[str],
+        workers: int = None,
+        queue_size: int = 16,
+        stream: bool = False,
+    ):
+        self.mapper_class = mapper_class
+        self.paths = list(paths)
+        self.workers = workers or multiprocessing.cpu_count()
+        self.queue_size = queue_size
+        self.stream = stream
+        self.stats = {}
+        self.errors = []
+
+    def run(self) -> Dict:
+        """
+        Run the pipeline and return the per-stage counters.
+        Raises `RuntimeError` if any document could not be mapped.
+        """
+        context = multiprocessing.get_context("fork")
+        paths_queue = context.Queue()
+        rows_queue = context.Queue(maxsize=self.queue_size)
+        for path in self.paths:
+            paths_queue.put(path)
+        workers = min(self.workers, len(self.paths)) or 1
+        for _ in range(workers):
+            paths_queue.put(None)
+
+        # forked workers must not share the parent's DB connections
+        connections.close_all()
+        processes = [
+            context.Process(
+                target=_map_documents,
+                args=(
+                    self.mapper_class,
+                    paths_queue,
+                    rows_queue,
+                    self.mapper_class.batch_size,
+                    self.stream,
+                ),
+            )
+            for _ in range(workers)
+        ]
+        self.stats = {
+            "documents": 0,
+            "rows_mapped": 0,
+            "rows_skipped": 0,
+            "rows_written": 0,
+            "parse_seconds": 0.0,
+            "write_seconds": 0.0,
+            "wait_seconds": 0.0,
+            "total_seconds": 0.0,
+        }
+        start = time.monotonic()
+        for process in processes:
+            process.start()
+        try:
+            writer = self.mapper_class()
+            writer.write_mapped(self._receive_rows(rows_queue, processes))
+        except BaseException:
+            # workers may be blocked on the full queue
+            for process in processes:
+                process.terminate()
+            raise
+        finally:
+            for process in processes:
+                process.join()
+
+        stats = self.stats
+        stats["total_seconds"] = time.monotonic() - start
+        stats["write_seconds"] = stats["total_seconds"] - stats["wait_seconds"]
+        stats["rows_skipped"] = writer.skipped_rows
+        stats["rows_written"] = stats["rows_mapped"] - writer.skipped_rows
+        stats["parse_rows_per_second"] = (
+            stats["rows_mapped"] / stats["parse_seconds"] if stats["parse_seconds"] else 0
+        )
+        stats["write_rows_per_second"] = (
+            stats["rows_written"] / stats["write_seconds"] if stats["write_seconds"] else 0
+        )
+        logger.info("%s pipeline: %s", self.mapper_class.__name__, stats)
+        if self.errors:
+            raise RuntimeError(
+                "Could not map {} documents: {}".format(len(self.errors), self.errors)
+            )
+        return stats
+
+    def _receive_rows(self, rows_queue, processes):
+        finished = 0
+        while finished < len(processes):
+            wait_start = time.monotonic()
+            try:
+                message = rows_queue.get(timeout=1)
+            except queue_module.Empty:
+                if not any(process.is_alive() for process in processes):
+                    raise RuntimeError("Pipeline workers exited unexpectedly")
+                continue
+            finally:
+                self.stats["wait_seconds"] += time.monotonic() - wait_start
+            kind = message[0]
+            if kind == "rows":
+                self.stats["rows_mapped"] += len(message[1])
+                yield from message[1]
+            elif kind == "document":
+                self.stats["documents"] += 1
+                self.stats["parse_seconds"] += message[3]
+            elif kind == "error":
+                self.errors.append((message[1], message[2]))
+            elif kind == "done":
+                finished += 1
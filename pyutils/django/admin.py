@@ -1,5 +1,7 @@
 from django.contrib import admin
 
+from pyutils.django.pagination import EstimatedCountPaginator
+
 
 class BaseDjangoAdmin(admin.ModelAdmin):
     """
@@ -30,6 +32,8 @@ class TimeStampedModelAdmin(BaseModelAdmin):
     )
     search_fields = ()
     ordering = ("-modified",)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
 
 TimeStampedAdmin = TimeStampedModelAdmin
@@ -40,10 +44,20 @@ class UserTimeStampedModelAdmin(BaseModelAdmin):
     Base Django Admin
     """
 
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        user_stamps = {"created_by_name", "modified_by_name"}
+        if hasattr(queryset, "with_user_stamps") and user_stamps.intersection(
+            self.get_list_display(request)
+        ):
+            queryset = queryset.with_user_stamps()
+        return queryset
+
     def save_model(self, request, obj, form, change):
-        try:
-            obj.created_by
-        except AttributeError:
+        if not obj.created_by_id:
             obj.created_by = request.user
         obj.modified_by = request.user
         super().save_model(request, obj, form, change)
@@ -1,20 +1,207 @@
-from typing import List, Union
+import asyncio
+import cProfile
+import inspect
+import json
+import multiprocessing
+import os
+import queue as queue_module
+import pstats
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager, nullcontext
+from typing import Callable, Iterable, List, Union
 
 import pendulum
-from django.core.management import BaseCommand
-from django.db.models import Model, QuerySet
+from django.core.management import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.db.models import Max, Min, Model, QuerySet
+
+
+@contextmanager
+def thread_pool(concurrency: int):
+    """
+    A `ThreadPoolExecutor` of `concurrency` threads that close their Django
+    DB connections before the pool is shut down.
+    """
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        yield executor
+    finally:
+        # every thread blocks on the barrier, so each one runs exactly one
+        # of these and closes its own (thread-local) connections
+        barrier = threading.Barrier(concurrency)
+
+        def close_connections():
+            connections.close_all()
+            barrier.wait()
+
+        for _ in range(concurrency):
+            executor.submit(close_connections)
+        executor.shutdown(wait=True)
+
+
+def run_concurrently(
+    func: Callable,
+    items: Iterable,
+    concurrency: int,
+    on_done: Callable = None,
+    executor: ThreadPoolExecutor = None,
+):
+    """
+    Call `func(item)` for every item with at most `concurrency` calls in
+    flight and return the results in order.
+
+    `async def` functions run on an asyncio loop, sync functions are
+    offloaded to `executor`, or a `thread_pool` of `concurrency` threads
+    for this call. `on_done(item)` is called (on the loop) as each item
+    completes.
+    """
+    if executor is not None or inspect.iscoroutinefunction(func):
+        return asyncio.run(
+            _gather_bounded(func, items, concurrency, on_done, executor)
+        )
+    with thread_pool(concurrency) as executor:
+        return asyncio.run(
+            _gather_bounded(func, items, concurrency, on_done, executor)
+        )
+
+
+async def _gather_bounded(func, items, concurrency, on_done, executor):
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    is_async = inspect.iscoroutinefunction(func)
+
+    async def run(item):
+        async with semaphore:
+            if is_async:
+                result = await func(item)
+            else:
+                result = await loop.run_in_executor(executor, func, item)
+        if on_done:
+            on_done(item)
+        return result
+
+    return await asyncio.gather(*(run(item) for item in items))
+
+
+class ActionProfiler:
+    """
+    Per-object latency and query counts of a `ModelActionCommand` run.
+    Optionally runs the action under cProfile.
+    """
+
+    def __init__(self, top: int = 10, dump_path: str = None):
+        self.top = top
+        self.dump_path = dump_path
+        self.timings = []  # (seconds, queries, object id)
+        self.queries = 0
+        self.profile = cProfile.Profile() if dump_path else None
+
+    def _count_query(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+    @contextmanager
+    def installed(self):
+        """
+        Count the queries on every DB connection while active.
+        """
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(self._count_query))
+            yield self
+
+    @contextmanager
+    def measure(self, object_id):
+        queries = self.queries
+        start = time.perf_counter()
+        if self.profile:
+            self.profile.enable()
+        try:
+            yield
+        finally:
+            if self.profile:
+                self.profile.disable()
+            seconds = time.perf_counter() - start
+            self.timings.append((seconds, self.queries - queries, object_id))
+
+    def report(self):
+        if not self.timings:
+            print("Profile: no objects processed")
+            return
+        latencies = sorted(timing[0] for timing in self.timings)
+        queries = [timing[1] for timing in self.timings]
+        n = len(latencies)
+        print(
+            "Profile: {} objects | mean {:.2f}ms | {} | max {:.2f}ms".format(
+                n,
+                sum(latencies) / n * 1000,
+                " | ".join(
+                    "p{} {:.2f}ms".format(p, percentile(latencies, p) * 1000)
+                    for p in (50, 90, 99)
+                ),
+                latencies[-1] * 1000,
+            )
+        )
+        print(
+            "Profile: queries/object | mean {:.2f} | max {} | total {}".format(
+                sum(queries) / n, max(queries), sum(queries)
+            )
+        )
+        print("Profile: slowest {} objects".format(min(self.top, n)))
+        slowest = sorted(self.timings, key=lambda timing: timing[0], reverse=True)
+        for seconds, n_queries, object_id in slowest[: self.top]:
+            print(
+                "    ID: {} | {:.2f}ms | {} queries".format(
+                    object_id, seconds * 1000, n_queries
+                )
+            )
+        if self.profile:
+            self.profile.dump_stats(self.dump_path)
+            print("Profile: cProfile stats written to {}".format(self.dump_path))
+            pstats.Stats(self.profile).sort_stats("cumulative").print_stats(20)
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    index = max(0, -(-len(sorted_values) * p // 100) - 1)
+    return sorted_values[int(index)]
 
 
 class ActionCommand(BaseCommand):
+    """
+    `async def` actions are run on an asyncio loop.
+    Actions can use `self.run_concurrently(func, items)` to process items
+    with `--concurrency` calls in flight.
+    """
+
+    concurrency = 1
+
     def add_arguments(self, parser):
         parser.add_argument("--action", type=str, help="Action to perform")
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            help="Maximum concurrent calls (default: {})".format(self.concurrency),
+        )
         return parser
 
     def handle(self, *args, **options):
         action = options.get("action")
         if not action:
             raise Exception("Action not specified")
-        getattr(self, action)()
+        self.concurrency = options.get("concurrency") or self.concurrency
+        func = getattr(self, action)
+        if inspect.iscoroutinefunction(func):
+            asyncio.run(func())
+        else:
+            func()
+
+    def run_concurrently(self, func: Callable, items: Iterable):
+        return run_concurrently(func, items, self.concurrency)
 
 
 class ModelActionCommand(BaseCommand):
@@ -22,9 +209,44 @@ class ModelActionCommand(BaseCommand):
     Base class for commands that need to load Django settings.
     Usage:
     python manage.py <command_name> --id 1 --action <method_name>
+
+    Instances are loaded in chunks of `--chunk-size` using pk ranges
+    (`id > last_id`), so the queryset is never held in memory at once.
+
+    With `--workers N` the id space is split into N ranges and each range
+    is processed in its own (forked) process with its own DB connection.
+
+    The last completed id is checkpointed per (model, action) after every
+    chunk in `--checkpoint-dir`; `--resume` continues after it. Worker runs
+    keep one checkpoint per id range. The checkpoint is removed once the
+    run completes.
+
+    `async def` actions, or any action with `--concurrency N`, are run N at
+    a time within each chunk: coroutines on an asyncio loop and sync
+    actions on a thread pool.
+
+    `--profile` prints per-object latency percentiles, queries per object
+    and the slowest `--profile-top` ids; `--profile-dump PATH` also runs
+    the action under cProfile and writes the stats to PATH.
+
+    If the command defines `<action>_batch(objs)`, it is called with each
+    chunk inside one transaction instead of calling `<action>(obj)` per
+    instance. The instances it returns are written with a single
+    `bulk_update` of `<action>_batch_fields` (all concrete fields if unset).
     """
 
     model_class = None
+    chunk_size = 1000
+    progress_every = 1
+    descending = False
+    workers = 1
+    progress_prefix = ""
+    checkpointing = False
+    checkpoint_dir = ".checkpoints"
+    checkpoint_suffix = ""
+    resume = False
+    concurrency = 1
+    profiler = None
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -38,6 +260,58 @@ class ModelActionCommand(BaseCommand):
             help="Execute action command on instances in descending order",
         )
         parser.add_argument("--action", type=str, help="Execute command on instance")
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            help="Number of instances loaded per query (default: {})".format(
+                self.chunk_size
+            ),
+        )
+        parser.add_argument(
+            "--progress-every",
+            type=int,
+            help="Print a progress line every N instances (default: {})".format(
+                self.progress_every
+            ),
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            help="Split the id space into N ranges processed in parallel",
+        )
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            help="Continue after the last checkpointed id",
+        )
+        parser.add_argument(
+            "--checkpoint-dir",
+            type=str,
+            help="Directory for checkpoint files (default: {})".format(
+                self.checkpoint_dir
+            ),
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            help="Maximum concurrent actions (default: {})".format(self.concurrency),
+        )
+        parser.add_argument(
+            "--profile",
+            action="store_true",
+            help="Print per-object latency and query statistics",
+        )
+        parser.add_argument(
+            "--profile-top",
+            type=int,
+            default=10,
+            help="Number of slowest objects to print with --profile",
+        )
+        parser.add_argument(
+            "--profile-dump",
+            type=str,
+            help="Run the action under cProfile and write the stats to this file",
+        )
         return parser
 
     def handle(self, *args, **options):
@@ -45,46 +319,356 @@ class ModelActionCommand(BaseCommand):
         Load Django settings.
         """
         object_id = options.get("id", None)
-        descending = options.get("desc", False)
+        self.descending = options.get("desc", False)
+        self.chunk_size = options.get("chunk_size") or self.chunk_size
+        self.progress_every = options.get("progress_every") or self.progress_every
+        self.workers = options.get("workers") or self.workers
+        self.resume = options.get("resume", False)
+        self.checkpoint_dir = options.get("checkpoint_dir") or self.checkpoint_dir
+        self.checkpointing = not object_id
+        self.concurrency = options.get("concurrency") or self.concurrency
         action = options.get("action")
 
         if not self.model_class:
             raise Exception("Model class not specified")
         if not action:
             raise Exception("Action not specified")
+        if self.resume and object_id:
+            raise CommandError("--resume cannot be combined with --id")
+        if options.get("profile") or options.get("profile_dump"):
+            if self.workers > 1 or self.concurrency > 1:
+                raise CommandError(
+                    "--profile cannot be combined with --workers or --concurrency"
+                )
+            self.profiler = ActionProfiler(
+                top=options.get("profile_top") or 10,
+                dump_path=options.get("profile_dump"),
+            )
 
         objs = self.model_class.objects.all().order_by("id")
-        if descending:
+        if self.descending:
             objs = objs.order_by("-id")
         if object_id:
             objs = objs.filter(id=object_id)
 
         start_time = pendulum.now()
-        self.run_action(action, objs)
+        if self.workers > 1 and not object_id:
+            self.run_action_in_workers(action, objs)
+        elif self.profiler:
+            with self.profiler.installed():
+                self.run_action(action, objs)
+        else:
+            self.run_action(action, objs)
         end_time = pendulum.now()
         delta = end_time - start_time
 
         print(
             "{}.{} took: {}".format(self.model_class.__name__, action, delta.in_words())
         )
+        if self.profiler:
+            self.profiler.report()
+
+    def measure(self, object_id):
+        """
+        Context manager timing one object (or chunk) when profiling.
+        """
+        if self.profiler:
+            return self.profiler.measure(object_id)
+        return nullcontext()
 
     def run_action(
         self,
         action: str,
         objs: Union[QuerySet | List[Model]],
     ):
+        if self.resume and self.checkpointing and isinstance(objs, QuerySet):
+            objs = self.resume_from_checkpoint(action, objs)
+        total = objs.count() if isinstance(objs, QuerySet) else len(objs)
+        batch_func = getattr(self, f"{action}_batch", None)
+        func = batch_func or getattr(self, action)
+        concurrent = self.concurrency > 1 or inspect.iscoroutinefunction(func)
+        with ExitStack() as stack:
+            # one thread pool for all the chunks of the run
+            executor = None
+            if concurrent and not batch_func and not inspect.iscoroutinefunction(func):
+                executor = stack.enter_context(thread_pool(self.concurrency))
+            n = 0
+            last_id = None
+            for chunk in self.iter_chunks(objs):
+                if batch_func:
+                    n = self._run_batch(action, batch_func, chunk, n, total, last_id)
+                    last_id = chunk[-1].id
+                elif concurrent:
+                    # ids complete out of order, so only whole chunks are checkpointed
+                    n = self._run_chunk_concurrently(
+                        action, chunk, n, total, last_id, executor
+                    )
+                    last_id = chunk[-1].id
+                else:
+                    for obj in chunk:
+                        n += 1
+                        try:
+                            with self.measure(obj.id):
+                                func(obj)
+                        except Exception as e:
+                            self._log_error(obj, e)
+                            if last_id is not None:
+                                self.save_checkpoint(action, last_id)
+                            raise e
+                        last_id = obj.id
+                        self.print_progress(action, obj, n, total)
+                self.save_checkpoint(action, last_id)
+        self.clear_checkpoint(action)
+        return n
+
+    def _run_batch(self, action, batch_func, chunk, n, total, last_id):
+        try:
+            label = "{}-{}".format(chunk[0].id, chunk[-1].id)
+            with self.measure(label), transaction.atomic():
+                updated = batch_func(chunk)
+                if updated:
+                    updated = list(updated)
+                    model_class = updated[0].__class__
+                    fields = getattr(self, f"{action}_batch_fields", None)
+                    if not fields:
+                        fields = [
+                            field.name
+                            for field in getattr(model_class, "_meta").concrete_fields
+                            if not field.primary_key
+                        ]
+                    model_class._default_manager.bulk_update(updated, fields)
+        except Exception as e:
+            print(e)
+            print(
+                "Error processing objects with ids: {}-{}".format(
+                    chunk[0].id, chunk[-1].id
+                )
+            )
+            self.save_checkpoint(action, last_id)
+            raise e
+        n += len(chunk)
+        print(
+            "{}{}/{} | {} IDs: {}-{} | {} updated".format(
+                self.progress_prefix,
+                n,
+                total,
+                chunk[-1].__class__.__name__,
+                chunk[0].id,
+                chunk[-1].id,
+                len(updated or []),
+            )
+        )
+        return n
+
+    def _run_chunk_concurrently(self, action, chunk, n, total, last_id, executor):
+        func = getattr(self, action)
+        done = [n]
+
+        def on_done(obj):
+            done[0] += 1
+            self.print_progress(action, obj, done[0], total)
+
+        if inspect.iscoroutinefunction(func):
+
+            async def call(obj):
+                try:
+                    return await func(obj)
+                except Exception as e:
+                    self._log_error(obj, e)
+                    raise e
+
+        else:
+
+            def call(obj):
+                try:
+                    return func(obj)
+                except Exception as e:
+                    self._log_error(obj, e)
+                    raise e
+
+        try:
+            run_concurrently(
+                call, chunk, self.concurrency, on_done=on_done, executor=executor
+            )
+        except Exception:
+            self.save_checkpoint(action, last_id)
+            raise
+        return done[0]
+
+    def print_progress(self, action: str, obj: Model, n: int, total: int):
+        if n % self.progress_every and n != total:
+            return
         log_callback = getattr(self, f"{action}_log", lambda obj: "")
-        for n, obj in enumerate(objs, 1):
+        print(
+            "{}{}/{} | {} ID: {} | {}".format(
+                self.progress_prefix,
+                n,
+                total,
+                obj.__class__.__name__,
+                obj.id,
+                log_callback(obj),
+            )
+        )
+
+    @staticmethod
+    def _log_error(obj: Model, e: Exception):
+        print(e)
+        print("Error processing object with id: {}".format(obj.id))
+
+    def checkpoint_path(self, action: str) -> str:
+        meta = getattr(self.model_class, "_meta")
+        fn = "{}.{}.{}{}{}.json".format(
+            meta.app_label,
+            meta.model_name,
+            action,
+            ".desc" if self.descending else "",
+            self.checkpoint_suffix,
+        )
+        return os.path.join(self.checkpoint_dir, fn)
+
+    def load_checkpoint(self, action: str):
+        """
+        Returns the last completed id, or None if there is no checkpoint.
+        """
+        try:
+            with open(self.checkpoint_path(action)) as f:
+                return json.load(f)["last_id"]
+        except FileNotFoundError:
+            return None
+
+    def save_checkpoint(self, action: str, last_id: int):
+        if not self.checkpointing or last_id is None:
+            return
+        path = self.checkpoint_path(action)
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        tmp_path = "{}.tmp".format(path)
+        with open(tmp_path, "w") as f:
+            json.dump({"last_id": last_id, "updated": pendulum.now().isoformat()}, f)
+        os.replace(tmp_path, path)
+
+    def clear_checkpoint(self, action: str):
+        if not self.checkpointing:
+            return
+        try:
+            os.remove(self.checkpoint_path(action))
+        except FileNotFoundError:
+            pass
+
+    def resume_from_checkpoint(self, action: str, objs: QuerySet) -> QuerySet:
+        last_id = self.load_checkpoint(action)
+        if last_id is None:
+            return objs
+        print("{}Resuming after ID: {}".format(self.progress_prefix, last_id))
+        if self.descending:
+            return objs.filter(id__lt=last_id)
+        return objs.filter(id__gt=last_id)
+
+    def run_action_in_workers(self, action: str, objs: QuerySet):
+        """
+        Run the action over `self.workers` id ranges in parallel processes
+        and print the per-worker timings.
+        """
+        bounds = objs.aggregate(min_id=Min("id"), max_id=Max("id"))
+        if bounds["min_id"] is None:
+            return 0
+        id_ranges = split_id_range(bounds["min_id"], bounds["max_id"], self.workers)
+        if self.descending:
+            id_ranges.reverse()
+
+        context = multiprocessing.get_context("fork")
+        results_queue = context.Queue()
+        # forked children must not share the parent's DB connections
+        connections.close_all()
+        processes = [
+            context.Process(
+                target=self._run_worker,
+                args=(action, objs, id_range, results_queue),
+            )
+            for id_range in id_ranges
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        results = []
+        for _ in processes:
             try:
-                getattr(self, action)(obj)
-            except Exception as e:
-                print(e)
-                print("Error processing object with id: {}".format(obj.id))
-                raise e
+                results.append(results_queue.get(timeout=5))
+            except queue_module.Empty:
+                break
+        results.sort(key=lambda result: result[0], reverse=self.descending)
+
+        total = 0
+        for (start_id, end_id), n, seconds, error in results:
+            total += n
             print(
-                "{}/{} | {} ID: {} | {}".format(
-                    n, objs.count(), obj.__class__.__name__, obj.id, log_callback(obj)
+                "Worker ids {}-{} | {} objects | took: {} | {:.1f}/s{}".format(
+                    start_id,
+                    end_id,
+                    n,
+                    pendulum.duration(seconds=seconds).in_words() or "0 seconds",
+                    n / seconds if seconds else 0,
+                    " | Error: {}".format(error) if error else "",
                 )
             )
+        print("Workers processed {} objects".format(total))
+
+        failed = len(processes) - len(results) + sum(1 for r in results if r[3])
+        if failed:
+            raise CommandError("{} of {} workers failed".format(failed, len(processes)))
+        return total
+
+    def _run_worker(self, action, objs, id_range, results_queue):
+        start_id, end_id = id_range
+        self.progress_prefix = "[{}-{}] ".format(start_id, end_id)
+        self.checkpoint_suffix = ".{}-{}".format(start_id, end_id)
+        start = time.monotonic()
+        n, error = 0, None
+        try:
+            n = self.run_action(
+                action, objs.filter(id__gte=start_id, id__lte=end_id)
+            )
+        except Exception as e:
+            error = repr(e)
+        finally:
+            connections.close_all()
+        results_queue.put((id_range, n, time.monotonic() - start, error))
+
+    def iter_chunks(self, objs: Union[QuerySet | List[Model]]):
+        """
+        Yield lists of at most `chunk_size` instances.
+        Querysets are paged on the primary key, so each chunk is one
+        indexed range query irrespective of how far into the table it is.
+        """
+        if not isinstance(objs, QuerySet):
+            for i in range(0, len(objs), self.chunk_size):
+                yield objs[i : i + self.chunk_size]
+            return
 
-        getattr(self, action, objs)
+        ordering, lookup = ("-id", "id__lt") if self.descending else ("id", "id__gt")
+        objs = objs.order_by(ordering)
+        last_id = None
+        while True:
+            chunk = objs
+            if last_id is not None:
+                chunk = chunk.filter(**{lookup: last_id})
+            chunk = list(chunk[: self.chunk_size])
+            if not chunk:
+                return
+            yield chunk
+            if len(chunk) < self.chunk_size:
+                return
+            last_id = chunk[-1].id
+
+
+def split_id_range(min_id: int, max_id: int, parts: int):
+    """
+    Split `min_id..max_id` (inclusive) into at most `parts` contiguous ranges.
+    split_id_range(1, 10, 3) => [(1, 4), (5, 8), (9, 10)]
+    """
+    size = -(-(max_id - min_id + 1) // parts)
+    return [
+        (start, min(start + size - 1, max_id))
+        for start in range(min_id, max_id + 1, size)
+    ]
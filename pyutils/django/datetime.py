@@ -1,9 +1,20 @@
+from functools import lru_cache
+
+import pytz
 from django.conf import settings
 from django.utils.timezone import now
 
 from pyutils.datetime import datetime_to_time_str, datetime_to_datetime_str
 
 
+@lru_cache(maxsize=None)
+def local_timezone():
+    """
+    `settings.LOCAL_TIME_ZONE` as a tz object, looked up once.
+    """
+    return pytz.timezone(settings.LOCAL_TIME_ZONE)
+
+
 def now_date():
     return now().date()
 
@@ -1,17 +1,250 @@
-from datetime import datetime, timedelta, time
+import zoneinfo
+from datetime import date, datetime, timedelta, time
 
-from dateutil.tz import tzutc
-from django.db.models import Manager
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+from django.db import connections
+from django.db.models import (
+    Count,
+    DateTimeField,
+    F,
+    Func,
+    Manager,
+    QuerySet,
+    Value,
+)
+from django.db.models.functions import TruncDay, TruncHour, TruncMonth
+from django.utils import timezone
 
+TRUNC_FUNCTIONS = {
+    "hour": TruncHour,
+    "day": TruncDay,
+    "month": TruncMonth,
+}
 
-class TimeStampedModelManager(Manager):
-    def records_today(self):
-        today = datetime.now().date()
-        tomorrow = today + timedelta(1)
-        today_start = datetime.combine(today, time(), tzutc())
-        today_end = datetime.combine(tomorrow, time(), tzutc())
-        return self.filter(created__lte=today_end, created__gte=today_start)
 
-    def records_current_month(self):
-        today = datetime.now()
-        return self.filter(created__year=today.year, created__month=today.month)
+def stamp_objs(model, objs, user=None, creating=False):
+    """
+    Fill the time stamps (`created`, `modified`) and user stamps
+    (`created_by`, `modified_by`) of unsaved or modified instances in
+    memory, as their `save()` would. Returns the stamped field names that
+    need to be written on update.
+    """
+    field_names = {field.name for field in model._meta.concrete_fields}
+    has_created = creating and "created" in field_names
+    has_modified = "modified" in field_names
+    has_created_by = creating and user is not None and "created_by" in field_names
+    has_modified_by = user is not None and "modified_by" in field_names
+    now = timezone.now()
+    for obj in objs:
+        if has_created and not obj.created:
+            obj.created = now
+        if has_modified:
+            obj.modified = obj.created if has_created else now
+        if has_created_by and not obj.created_by_id:
+            obj.created_by = user
+        if has_modified_by:
+            obj.modified_by = user
+    update_fields = set()
+    if has_modified:
+        update_fields.add("modified")
+    if has_modified_by:
+        update_fields.add("modified_by")
+    return update_fields
+
+
+def _zoneinfo(tz):
+    """
+    `tz` as a `ZoneInfo` when it is a pytz zone: `make_aware` and `Trunc`
+    just attach the tzinfo, which gives LMT offsets with pytz.
+    """
+    if tz is not None and hasattr(tz, "localize"):
+        return zoneinfo.ZoneInfo(tz.zone)
+    return tz
+
+
+def _start_of_day(day: date, tz):
+    return timezone.make_aware(datetime.combine(day, time()), _zoneinfo(tz))
+
+
+def _next_month(day: date) -> date:
+    return (day.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+
+def bucket_starts(bucket: str, start: datetime, end: datetime, tz):
+    """
+    Yield the start of every hour/day/month bucket (in `tz`) that overlaps
+    [start, end).
+    """
+    tz = _zoneinfo(tz)
+    local = timezone.localtime(start, tz)
+    if bucket == "hour":
+        current = local.replace(minute=0, second=0, microsecond=0)
+    elif bucket == "day":
+        current = _start_of_day(local.date(), tz)
+    elif bucket == "month":
+        current = _start_of_day(local.date().replace(day=1), tz)
+    else:
+        raise ValueError("bucket must be one of {}".format(list(TRUNC_FUNCTIONS)))
+    while current < end:
+        yield current
+        if bucket == "hour":
+            current = timezone.localtime(current + timedelta(hours=1), tz)
+        elif bucket == "day":
+            current = _start_of_day(current.date() + timedelta(days=1), tz)
+        else:
+            current = _start_of_day(_next_month(current.date()), tz)
+
+
+class AtTimeZone(Func):
+    """
+    PostgreSQL `<timestamptz> AT TIME ZONE <tz>`: the wall-clock time in
+    `tz` as a naive datetime.
+    """
+
+    arg_joiner = " AT TIME ZONE "
+    template = "(%(expressions)s)"
+    output_field = DateTimeField()
+
+    def __init__(self, expression, tz_name, **extra):
+        super().__init__(expression, Value(tz_name), **extra)
+
+
+class StampedQuerySet(QuerySet):
+    """
+    Bulk helpers that fill the time stamps and user stamps, see `stamp_objs`.
+    """
+
+    def bulk_create_stamped(self, objs, user=None, **kwargs):
+        """
+        `bulk_create` with the time stamps (and user stamps, if `user` is
+        given and the model has them) filled in.
+        """
+        objs = list(objs)
+        stamp_objs(self.model, objs, user=user, creating=True)
+        return self.bulk_create(objs, **kwargs)
+
+    def bulk_update_stamped(self, objs, fields, user=None, **kwargs):
+        """
+        `bulk_update` that also sets and writes `modified` (and
+        `modified_by`, if `user` is given and the model has it).
+        """
+        objs = list(objs)
+        stamped_fields = stamp_objs(self.model, objs, user=user)
+        return self.bulk_update(objs, set(fields).union(stamped_fields), **kwargs)
+
+
+class TimeStampedQuerySet(StampedQuerySet):
+    """
+    The date helpers filter `created` with half-open ranges
+    (`created >= start AND created < end`), so the index on `created` is
+    used. Days and months are those of `tz`, the current timezone by default.
+    """
+
+    def records_today(self, tz=None):
+        tz = _zoneinfo(tz or timezone.get_current_timezone())
+        today = timezone.localtime(timezone=tz).date()
+        return self.filter(
+            created__gte=_start_of_day(today, tz),
+            created__lt=_start_of_day(today + timedelta(days=1), tz),
+        )
+
+    def records_current_month(self, tz=None):
+        tz = _zoneinfo(tz or timezone.get_current_timezone())
+        month = timezone.localtime(timezone=tz).date().replace(day=1)
+        return self.filter(
+            created__gte=_start_of_day(month, tz),
+            created__lt=_start_of_day(_next_month(month), tz),
+        )
+
+    def counts_by(self, bucket: str, start: datetime, end: datetime, tz=None):
+        """
+        Number of records created per hour/day/month in [start, end).
+
+        The records are grouped in the database, truncated in `tz` (the
+        current timezone by default). Returns a list of
+        (bucket start, count) for every bucket, including the empty ones.
+        """
+        if bucket not in TRUNC_FUNCTIONS:
+            raise ValueError("bucket must be one of {}".format(list(TRUNC_FUNCTIONS)))
+        tz = _zoneinfo(tz or timezone.get_current_timezone())
+        rows = (
+            self.filter(created__gte=start, created__lt=end)
+            .annotate(_bucket=TRUNC_FUNCTIONS[bucket]("created", tzinfo=tz))
+            .values("_bucket")
+            .annotate(_count=Count("pk"))
+            .order_by("_bucket")
+        )
+        counts = {row["_bucket"]: row["_count"] for row in rows}
+        return [
+            (bucket_start, counts.get(bucket_start, 0))
+            for bucket_start in bucket_starts(bucket, start, end, tz)
+        ]
+
+    def with_local_timestamps(self):
+        """
+        Annotate `created_local` and `modified_local`, the time stamps in
+        `settings.LOCAL_TIME_ZONE` as naive datetimes converted by the
+        database. These are read by `LocalTimeStampField` and
+        `TimeStampedModel.get_local_created` / `get_local_modified`.
+
+        Only PostgreSQL supports it, on other databases the queryset is
+        returned as is and the conversion is done in Python.
+        """
+        if connections[self.db].vendor != "postgresql":
+            return self
+        tz_name = settings.LOCAL_TIME_ZONE
+        return self.annotate(
+            created_local=AtTimeZone("created", tz_name),
+            modified_local=AtTimeZone("modified", tz_name),
+        )
+
+
+class TimeStampedModelManager(Manager.from_queryset(TimeStampedQuerySet)):
+    pass
+
+
+def _has_field(model, name):
+    try:
+        model._meta.get_field(name)
+    except FieldDoesNotExist:
+        return False
+    return True
+
+
+class UserStampedQuerySet(StampedQuerySet):
+    """
+    QuerySet for models with ``created_by`` and ``modified_by`` user stamps.
+    """
+
+    def with_user_stamps(self, select_users=False):
+        """
+        Fetch the creator and modifier names in the same query.
+
+        The names are annotated as ``_created_by_name`` and
+        ``_modified_by_name`` which are read by
+        ``UserStampedModel.created_by_name`` / ``modified_by_name``.
+        Pass ``select_users=True`` to join the complete user rows instead,
+        which is also done when the user model has no ``name`` field.
+        """
+        user_model = self.model._meta.get_field("created_by").related_model
+        if select_users or not _has_field(user_model, "name"):
+            return self.select_related("created_by", "modified_by")
+        return self.annotate(
+            _created_by_name=F("created_by__name"),
+            _modified_by_name=F("modified_by__name"),
+        )
+
+
+class UserStampedModelManager(Manager.from_queryset(UserStampedQuerySet)):
+    pass
+
+
+class UserTimeStampedQuerySet(TimeStampedQuerySet, UserStampedQuerySet):
+    pass
+
+
+class UserTimeStampedModelManager(
+    TimeStampedModelManager.from_queryset(UserTimeStampedQuerySet)
+):
+    pass
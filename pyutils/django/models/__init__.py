@@ -1,15 +1,22 @@
 # from python_utils import formatters
-import pytz
+import copy
+
 from cities_light.models import Country, Region, SubRegion
 from django.conf import settings
 from django.db import models
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from model_utils import models as mu_models
 from model_utils.fields import AutoCreatedField, AutoLastModifiedField
 from rest_framework.exceptions import ValidationError
 from smart_selects.db_fields import ChainedForeignKey
 
-from pyutils.django.managers import TimeStampedModelManager
+from pyutils.django.datetime import local_timezone
+from pyutils.django.managers import (
+    TimeStampedModelManager,
+    UserStampedModelManager,
+    UserTimeStampedModelManager,
+)
 from pyutils.string import pascal_case_to_dash_case, pascal_case_to_underscore_case
 
 SubRegion.__str__ = lambda x: x.name
@@ -49,7 +56,136 @@ class NameMixin(object):
         return f"<{self.__class__.__name__}[{self.pk or -1:d}]: {self.name}>"
 
 
+def _snapshot_value(value):
+    if isinstance(value, (dict, list)):
+        return copy.deepcopy(value)
+    return value
+
+
 class BaseModel(models.Model, IdMixin):
+    """
+    Set `track_dirty_fields = True` on a model to snapshot the values
+    loaded from the database. `save()` then only writes the changed fields
+    (plus fields updated on every save, eg `modified`) and does nothing if
+    no field changed. Explicit `update_fields` are always respected.
+
+    Note: changes made by `pre_save` signal handlers to other fields are
+    not saved for such models.
+    """
+
+    track_dirty_fields = False
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if cls.track_dirty_fields:
+            instance._snapshot_loaded_values()
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        # also used to load deferred fields
+        super().refresh_from_db(using=using, fields=fields, **kwargs)
+        loaded_values = self.__dict__.get("_loaded_values")
+        if loaded_values is None:
+            return
+        if fields is None:
+            refreshed = self._meta.concrete_fields
+        else:
+            refreshed = [self._meta.get_field(name) for name in fields]
+        for field in refreshed:
+            if field.concrete and field.attname in self.__dict__:
+                loaded_values[field.attname] = _snapshot_value(
+                    self.__dict__[field.attname]
+                )
+
+    def _snapshot_loaded_values(self):
+        self._loaded_values = {
+            field.attname: _snapshot_value(self.__dict__[field.attname])
+            for field in self._meta.concrete_fields
+            if field.attname in self.__dict__
+        }
+
+    def get_dirty_fields(self):
+        """
+        Names of the fields changed since the instance was loaded or saved.
+        Returns None if the instance is not tracked.
+        """
+        loaded_values = self.__dict__.get("_loaded_values")
+        if loaded_values is None:
+            return None
+        dirty_fields = []
+        for field in self._meta.concrete_fields:
+            if field.attname not in self.__dict__:
+                continue  # deferred
+            if (
+                field.attname not in loaded_values
+                or loaded_values[field.attname] != self.__dict__[field.attname]
+            ):
+                dirty_fields.append(field.name)
+        return dirty_fields
+
+    @classmethod
+    def _auto_updated_fields(cls):
+        return [
+            field
+            for field in cls._meta.concrete_fields
+            if getattr(field, "auto_now", False)
+            or isinstance(field, AutoLastModifiedField)
+        ]
+
+    def save(self, *args, **kwargs):
+        if (
+            self.track_dirty_fields
+            and not args
+            and not self._state.adding
+            and kwargs.get("update_fields") is None
+            and not kwargs.get("force_insert")
+        ):
+            dirty_fields = self.get_dirty_fields()
+            if dirty_fields is not None:
+                if not dirty_fields:
+                    return
+                auto_fields = [f.name for f in self._auto_updated_fields()]
+                kwargs["update_fields"] = set(dirty_fields).union(auto_fields)
+        super().save(*args, **kwargs)
+        if self.track_dirty_fields:
+            update_fields = kwargs.get("update_fields")
+            if update_fields is None or "_loaded_values" not in self.__dict__:
+                self._snapshot_loaded_values()
+            else:
+                # the fields that were not written stay dirty
+                update_fields = set(update_fields)
+                for field in self._meta.concrete_fields:
+                    if field.name in update_fields or field.attname in update_fields:
+                        self._loaded_values[field.attname] = _snapshot_value(
+                            self.__dict__.get(field.attname)
+                        )
+
+    @classmethod
+    def bulk_save_dirty(cls, objs, batch_size=None):
+        """
+        Save the changed fields of tracked instances with one `bulk_update`
+        per set of changed fields. Unchanged instances are skipped.
+        Returns the number of instances updated.
+        """
+        groups = {}
+        for obj in objs:
+            dirty_fields = obj.get_dirty_fields()
+            if dirty_fields:
+                groups.setdefault(frozenset(dirty_fields), []).append(obj)
+
+        auto_fields = cls._auto_updated_fields()
+        n = 0
+        for dirty_fields, group in groups.items():
+            for obj in group:
+                for field in auto_fields:
+                    field.pre_save(obj, False)
+            fields = dirty_fields.union(field.name for field in auto_fields)
+            n += cls._default_manager.bulk_update(group, fields, batch_size=batch_size)
+            for obj in group:
+                obj._snapshot_loaded_values()
+        return n
+
     @classmethod
     @property
     def model_name_verbose(cls):
@@ -152,21 +288,29 @@ class UserStampedModel(models.Model):
         related_name="%(app_label)s_%(class)s_modifiedby_relationship",
     )
 
-    @property
-    def created_by_name(self):
-        return self.created_by.name
+    objects = UserStampedModelManager()
 
     @property
-    def created_by_id(self):
-        return self.created_by.id
+    def created_by_name(self):
+        """
+        Name of the creator.
+        Uses the name annotated by ``with_user_stamps()`` when available.
+        """
+        try:
+            return self.__dict__["_created_by_name"]
+        except KeyError:
+            return self.created_by.name
 
     @property
     def modified_by_name(self):
-        return self.modified_by.name
-
-    @property
-    def modified_by_id(self):
-        return self.modified_by.id
+        """
+        Name of the modifier.
+        Uses the name annotated by ``with_user_stamps()`` when available.
+        """
+        try:
+            return self.__dict__["_modified_by_name"]
+        except KeyError:
+            return self.modified_by.name
 
     def _save_user_stamps(self, *args, **kwargs):
         # self.modified_by = self.get_
@@ -193,22 +337,28 @@ class TimeStampedModel(mu_models.TimeStampedModel, BaseModel):
             kwargs["update_fields"] = set(update_fields).union({"modified"})
 
     def get_local_created(self):
-        return self._dt_to_str_local_tz(self.created)
+        # `created_local` is annotated by `with_local_timestamps()`
+        return self._dt_to_str_local_tz(
+            self.__dict__.get("created_local") or self.created
+        )
 
     get_local_created.admin_order_field = "created"
     get_local_created.short_description = "Created"
 
     def get_local_modified(self):
-        return self._dt_to_str_local_tz(self.modified)
+        return self._dt_to_str_local_tz(
+            self.__dict__.get("modified_local") or self.modified
+        )
 
     get_local_modified.admin_order_field = "modified"
     get_local_modified.short_description = "Modified"
 
     @staticmethod
     def _dt_to_str_local_tz(dt):
-        return dt.astimezone(pytz.timezone(settings.LOCAL_TIME_ZONE)).strftime(
-            "%d %b %Y %I:%M %p"
-        )
+        # naive datetimes are already in local time
+        if timezone.is_aware(dt):
+            dt = dt.astimezone(local_timezone())
+        return dt.strftime("%d %b %Y %I:%M %p")
 
     @property
     def created_at(self):
@@ -278,6 +428,8 @@ class NameTimeStampedModel(NameModel, TimeStampedModel):
 
 
 class UserTimeStampedModel(UserStampedModel, TimeStampedModel):
+    objects = UserTimeStampedModelManager()
+
     def save(self, *args, **kwargs):
         self._save_user_stamps(*args, **kwargs)
         self._save_time_stamps(*args, **kwargs)
@@ -1,4 +1,18 @@
-from rest_framework.pagination import PageNumberPagination
+import hashlib
+import json
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q, QuerySet
+from django.utils.functional import cached_property
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 
 
 class SmallResultsSetPagination(PageNumberPagination):
@@ -14,3 +28,264 @@ class PageNumberPagination20(PageNumberPagination):
 class PageNumberPagination30(PageNumberPagination):
     page_size = 30
     max_page_size = 30
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Django paginator that avoids an exact `COUNT(*)` on large tables.
+
+    On PostgreSQL the planner's row estimate is used when it is above
+    `estimate_threshold`; smaller results are counted exactly. On other
+    databases (eg SQLite) exact counts above the threshold are cached for
+    `count_cache_timeout` seconds. `is_approximate` tells whether `count`
+    is an estimate or a cached value.
+    """
+
+    estimate_threshold = 10000
+    count_cache_timeout = 60
+    is_approximate = False
+
+    @cached_property
+    def count(self):
+        if not isinstance(self.object_list, QuerySet):
+            return super().count
+        queryset = self.object_list.order_by()
+        if connections[queryset.db].vendor == "postgresql":
+            estimate = self._planner_estimate(queryset)
+            if estimate >= self.estimate_threshold:
+                self.is_approximate = True
+                return estimate
+            return queryset.count()
+        return self._cached_count(queryset)
+
+    @staticmethod
+    def _planner_estimate(queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connections[queryset.db].cursor() as cursor:
+            cursor.execute("EXPLAIN (FORMAT JSON) {}".format(sql), params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]["Plan"]["Plan Rows"])
+
+    def _cached_count(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        key = "pyutils:count:{}".format(
+            hashlib.md5("{}{}{}".format(queryset.db, sql, params).encode()).hexdigest()
+        )
+        count = cache.get(key)
+        if count is not None:
+            self.is_approximate = True
+            return count
+        count = queryset.count()
+        if count >= self.estimate_threshold:
+            cache.set(key, count, self.count_cache_timeout)
+        return count
+
+
+class EstimatedCountPageNumberPagination(PageNumberPagination):
+    """
+    Page number pagination using `EstimatedCountPaginator`.
+    The response has `count_approximate` set when `count` is an estimate.
+    """
+
+    django_paginator_class = EstimatedCountPaginator
+
+    def get_paginated_response(self, data):
+        response = super().get_paginated_response(data)
+        response.data["count_approximate"] = self.page.paginator.is_approximate
+        return response
+
+    def get_paginated_response_schema(self, schema):
+        response_schema = super().get_paginated_response_schema(schema)
+        response_schema["properties"]["count_approximate"] = {"type": "boolean"}
+        return response_schema
+
+
+class EstimatedCountPagination20(EstimatedCountPageNumberPagination):
+    page_size = 20
+    max_page_size = 20
+
+
+class EstimatedCountPagination30(EstimatedCountPageNumberPagination):
+    page_size = 30
+    max_page_size = 30
+
+
+def pack_cursor(cursor):
+    """
+    Encode the `cursor` dict as an opaque string, dates in ISO format.
+    """
+    cursor = {
+        key: value.isoformat() if hasattr(value, "isoformat") else value
+        for key, value in cursor.items()
+    }
+    return b64encode(json.dumps(cursor).encode("utf-8")).decode("ascii")
+
+
+def unpack_cursor(encoded, converters, invalid_message, optional=()):
+    """
+    Decode a `pack_cursor` string. `converters` maps every key to the function
+    parsing its value (eg `field.to_python`); keys in `optional` may be
+    missing. Raises `NotFound(invalid_message)` on a malformed cursor.
+    """
+    try:
+        cursor = json.loads(b64decode(encoded.encode("ascii")).decode("utf-8"))
+        values = {
+            key: convert(cursor[key])
+            for key, convert in converters.items()
+            if key not in optional or key in cursor
+        }
+    except (KeyError, TypeError, ValueError, ValidationError):
+        raise NotFound(invalid_message)
+    if None in values.values():
+        raise NotFound(invalid_message)
+    return values
+
+
+def seek_filter(field_name, value, pk, lookup):
+    """
+    `(field, id) > (value, pk)` with `lookup="gt"`, or `<` with `"lt"`,
+    written so that the index on `field` is used.
+    """
+    return Q(**{f"{field_name}__{lookup}": value}) | Q(
+        **{field_name: value, f"id__{lookup}": pk}
+    )
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset (seek) pagination on an indexed column with `id` as tiebreaker.
+
+    Pages are fetched with `WHERE (field, id) < (value, id) LIMIT n` instead
+    of `OFFSET`, and no `COUNT(*)` is run, so deep pages cost the same as
+    the first one. The cursor is opaque to the client.
+    """
+
+    ordering = "-created"
+    page_size = 30
+    max_page_size = None
+    page_size_query_param = None
+    cursor_query_param = "cursor"
+    invalid_cursor_message = "Invalid cursor"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        self.field_name = self.ordering.lstrip("-")
+        self.descending = self.ordering.startswith("-")
+        field = queryset.model._meta.get_field(self.field_name)
+
+        cursor = self.decode_cursor(request, field)
+        reverse = False
+        if cursor is not None:
+            reverse = cursor.get("r", False)
+            # `descending` xor `reverse` decides which side of the cursor to seek
+            lookup = "lt" if self.descending != reverse else "gt"
+            queryset = queryset.filter(
+                seek_filter(self.field_name, cursor["v"], cursor["id"], lookup)
+            )
+
+        desc = self.descending != reverse
+        ordering = [f"-{self.field_name}", "-id"] if desc else [self.field_name, "id"]
+        results = list(queryset.order_by(*ordering)[: self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[: self.page_size]
+        if reverse:
+            results.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, cursor is not None
+
+        self.page = results
+        return results
+
+    def get_page_size(self, request):
+        if self.page_size_query_param:
+            try:
+                page_size = int(request.query_params[self.page_size_query_param])
+                if page_size > 0:
+                    if self.max_page_size:
+                        return min(page_size, self.max_page_size)
+                    return page_size
+            except (KeyError, ValueError):
+                pass
+        return self.page_size
+
+    def decode_cursor(self, request, field):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        return unpack_cursor(
+            encoded,
+            {"v": field.to_python, "id": int, "r": bool},
+            self.invalid_cursor_message,
+            optional=("r",),
+        )
+
+    def encode_cursor(self, obj, reverse=False):
+        cursor = {"v": getattr(obj, self.field_name), "id": obj.id}
+        if reverse:
+            cursor["r"] = True
+        return replace_query_param(
+            self.base_url, self.cursor_query_param, pack_cursor(cursor)
+        )
+
+    def get_next_link(self):
+        if not (self.has_next and self.page):
+            return None
+        return self.encode_cursor(self.page[-1])
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def get_paginated_response(self, data):
+        return Response(
+            OrderedDict(
+                [
+                    ("next", self.get_next_link()),
+                    ("previous", self.get_previous_link()),
+                    ("results", data),
+                ]
+            )
+        )
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "required": ["results"],
+            "properties": {
+                "next": {"type": "string", "nullable": True, "format": "uri"},
+                "previous": {"type": "string", "nullable": True, "format": "uri"},
+                "results": schema,
+            },
+        }
+
+
+class CreatedKeysetPagination(KeysetPagination):
+    """
+    Newest created first.
+    """
+
+    ordering = "-created"
+
+
+class ModifiedKeysetPagination(KeysetPagination):
+    """
+    Most recently modified first.
+    """
+
+    ordering = "-modified"
+
+
+class CreatedKeysetPagination20(CreatedKeysetPagination):
+    page_size = 20
+
+
+class ModifiedKeysetPagination20(ModifiedKeysetPagination):
+    page_size = 20
@@ -1,20 +1,56 @@
-import pytz
-from django.conf import settings
-from rest_framework import serializers
-from rest_framework.serializers import ModelSerializer, HyperlinkedModelSerializer
+import copy
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Model, Q, QuerySet
+from django.db.models.manager import BaseManager
+from django.utils import timezone
+from django.utils.functional import cached_property
+from rest_framework import fields, relations, serializers
+from rest_framework.fields import SkipField
+from rest_framework.relations import PKOnlyObject
+from rest_framework.serializers import (
+    LIST_SERIALIZER_KWARGS,
+    BaseSerializer,
+    HyperlinkedModelSerializer,
+    ListSerializer,
+    ModelSerializer,
+)
 from rest_framework.settings import api_settings
 
+from pyutils.django.datetime import local_timezone
 from pyutils.django.models import BaseModel
 
 
 class LocalTimeStampField(serializers.DateTimeField):
-    def __init__(self):
+    """
+    Read-only time stamp in `settings.LOCAL_TIME_ZONE`.
+
+    When the instance has the `local_source` annotation (eg `created_local`
+    from `with_local_timestamps()`) it is used as is, since the database
+    already converted it to local time. Otherwise `source` is converted in
+    Python.
+    """
+
+    def __init__(self, local_source=None):
+        self.local_source = local_source
         super(LocalTimeStampField, self).__init__(
             read_only=True,
             format=api_settings.DATETIME_FORMAT,
-            default_timezone=pytz.timezone(settings.LOCAL_TIME_ZONE),
+            default_timezone=local_timezone(),
         )
 
+    def get_attribute(self, instance):
+        annotations = getattr(instance, "__dict__", {})
+        if self.local_source and self.local_source in annotations:
+            return annotations[self.local_source]
+        return super().get_attribute(instance)
+
+    def enforce_timezone(self, value):
+        # naive values are local time converted by the database
+        if timezone.is_naive(value):
+            return local_timezone().localize(value)
+        return super().enforce_timezone(value)
+
 
 class GenericSerializer(ModelSerializer):
     class Meta:
@@ -23,27 +59,281 @@ class GenericSerializer(ModelSerializer):
         fields = "__all__"
 
 
+# the field's own `to_representation` is used for the value
+_FIELD_TO_REPRESENTATION = object()
+
+# DRF fields whose `to_representation` is a plain builtin
+_FAST_READ_CONVERTERS = {
+    fields.CharField: str,
+    fields.EmailField: str,
+    fields.SlugField: str,
+    fields.URLField: str,
+    fields.IntegerField: int,
+    fields.FloatField: float,
+    fields.BooleanField: bool,
+}
+
+# (serializer class, field name, field class, source) => `_fast_read_spec`
+_fast_read_plans = {}
+
+# serializer class => unbound fields returned by `ModelSerializer.get_fields`
+_fields_cache = {}
+
+
+def _fast_read_spec(model, field):
+    """
+    Returns `(attname, convert)` when the field can be read straight off a
+    concrete model column, else None (regular DRF path).
+    `convert` None means the column value is used as is.
+    """
+    if isinstance(field, (BaseSerializer, relations.ManyRelatedField)):
+        return None
+    if not field.source_attrs or len(field.source_attrs) > 1:
+        return None
+    try:
+        model_field = model._meta.get_field(field.source)
+    except FieldDoesNotExist:
+        return None
+    if not model_field.concrete or model_field.many_to_many:
+        return None
+    if isinstance(field, relations.RelatedField):
+        if (
+            type(field) is relations.PrimaryKeyRelatedField
+            and field.pk_field is None
+            and model_field.is_relation
+        ):
+            return model_field.attname, None
+        return None
+    if model_field.is_relation:
+        return None
+    if type(field).get_attribute is not fields.Field.get_attribute:
+        return None
+    convert = _FAST_READ_CONVERTERS.get(type(field), _FIELD_TO_REPRESENTATION)
+    return model_field.attname, convert
+
+
 class BaseModelSerializer(ModelSerializer):
+    # used for `many=True` unless `Meta.list_serializer_class` is set
+    list_serializer_class = ListSerializer
+
+    # read concrete columns through a precompiled plan, see `fast_read_plan`
+    fast_read = False
+
+    # build `get_fields()` once per class, see `get_fields`
+    cache_fields = False
+
     @property
     def model(self) -> type[BaseModel]:
         return getattr(self, "Meta").model
 
+    @classmethod
+    def many_init(cls, *args, **kwargs):
+        """
+        Same as `Serializer.many_init`, but falls back to
+        `cls.list_serializer_class` instead of `ListSerializer`.
+        """
+        allow_empty = kwargs.pop("allow_empty", None)
+        max_length = kwargs.pop("max_length", None)
+        min_length = kwargs.pop("min_length", None)
+        child_serializer = cls(*args, **kwargs)
+        list_kwargs = {"child": child_serializer}
+        if allow_empty is not None:
+            list_kwargs["allow_empty"] = allow_empty
+        if max_length is not None:
+            list_kwargs["max_length"] = max_length
+        if min_length is not None:
+            list_kwargs["min_length"] = min_length
+        list_kwargs.update(
+            {
+                key: value
+                for key, value in kwargs.items()
+                if key in LIST_SERIALIZER_KWARGS
+            }
+        )
+        meta = getattr(cls, "Meta", None)
+        list_serializer_class = getattr(
+            meta, "list_serializer_class", cls.list_serializer_class
+        )
+        return list_serializer_class(*args, **list_kwargs)
+
+    def get_fields(self):
+        """
+        `ModelSerializer.get_fields` introspects the model on every
+        instantiation. With `cache_fields = True` the fields are built once
+        per class instead, and each instance gets a deep copy of them.
+
+        Only enable it when the fields do not depend on `self.context` or
+        `self.instance`, eg through `get_field_names`, `get_extra_kwargs` or
+        `build_field`: the fields of the first instance are reused for all.
+        """
+        if not self.cache_fields:
+            return super().get_fields()
+        cached = _fields_cache.get(type(self))
+        if cached is None:
+            cached = super().get_fields()
+            _fields_cache[type(self)] = cached
+        return copy.deepcopy(cached)
+
+    @cached_property
+    def fast_read_plan(self):
+        """
+        List of `(field_name, attname, convert, field)` for the readable
+        fields.
+
+        Fields backed by a single concrete column (and pk-only foreign keys)
+        are read with `getattr(instance, attname)` and converted with a
+        builtin or the field's `to_representation`. `attname` is None for
+        everything else, which goes through `field.get_attribute`.
+        The per-field analysis is done once per serializer class.
+        """
+        plan = []
+        for field in self._readable_fields:
+            key = (type(self), field.field_name, type(field), field.source)
+            try:
+                spec = _fast_read_plans[key]
+            except KeyError:
+                spec = _fast_read_plans[key] = _fast_read_spec(self.model, field)
+            if spec is None:
+                plan.append((field.field_name, None, None, field))
+                continue
+            attname, convert = spec
+            if convert is _FIELD_TO_REPRESENTATION:
+                convert = field.to_representation
+            plan.append((field.field_name, attname, convert, field))
+        return plan
+
+    def to_representation(self, instance):
+        if not (self.fast_read and isinstance(instance, Model)):
+            return super().to_representation(instance)
+        ret = {}
+        for field_name, attname, convert, field in self.fast_read_plan:
+            if attname is not None:
+                value = getattr(instance, attname)
+                if value is None or convert is None:
+                    ret[field_name] = value
+                else:
+                    ret[field_name] = convert(value)
+                continue
+            # same as `Serializer.to_representation`
+            try:
+                attribute = field.get_attribute(instance)
+            except SkipField:
+                continue
+            check_for_none = (
+                attribute.pk if isinstance(attribute, PKOnlyObject) else attribute
+            )
+            if check_for_none is None:
+                ret[field_name] = None
+            else:
+                ret[field_name] = field.to_representation(attribute)
+        return ret
+
+
+class ValuesListSerializer(ListSerializer):
+    """
+    List serializer for `fast_read` serializers that reads querysets with
+    `.values_list()` instead of building model instances.
+
+    Used only when every field of the child is a plain column read,
+    otherwise (and for lists, eg a paginated page) it behaves like
+    `ListSerializer`. Set it as `list_serializer_class` to enable.
+    """
+
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, BaseManager) else data
+        if not (
+            isinstance(iterable, QuerySet) and getattr(self.child, "fast_read", False)
+        ):
+            return super().to_representation(data)
+        plan = self.child.fast_read_plan
+        if any(attname is None for _, attname, _, _ in plan):
+            return super().to_representation(data)
+
+        names = [field_name for field_name, _, _, _ in plan]
+        converters = [convert for _, _, convert, _ in plan]
+        rows = iterable.values_list(*[attname for _, attname, _, _ in plan])
+        return [
+            {
+                name: value if value is None or convert is None else convert(value)
+                for name, value, convert in zip(names, row, converters)
+            }
+            for row in rows
+        ]
+
 
 class BaseHyperlinkedModelSerializer(HyperlinkedModelSerializer):
     pass
 
 
+def _is_id(data):
+    return isinstance(data, int) and data > 0
+
+
+def _is_name_or_id(data):
+    return _is_id(data) or (isinstance(data, str) and len(data) > 0)
+
+
+def _as_id(value):
+    if _is_id(value):
+        return value
+    if isinstance(value, str) and value.isdigit():
+        return int(value)
+    return None
+
+
+class LookupListSerializer(ListSerializer):
+    """
+    Resolves a list of lookup values (ids, names) with a single query.
+
+    The child serializer provides `_is_lookup_value(data)` and
+    `_get_objects(values)`, which returns a dict of value => instance.
+    """
+
+    def to_internal_value(self, data):
+        is_lookup_value = self.child._is_lookup_value
+        if not (isinstance(data, list) and data and all(map(is_lookup_value, data))):
+            return super().to_internal_value(data)
+        if self.max_length is not None and len(data) > self.max_length:
+            self.fail("max_length", max_length=self.max_length)
+        if self.min_length is not None and len(data) < self.min_length:
+            self.fail("min_length", min_length=self.min_length)
+        objects = self.child._get_objects(data)
+        return [objects[value] for value in data]
+
+
 class IdModelSerializer(BaseModelSerializer):
+    list_serializer_class = LookupListSerializer
+
     # def to_representation(self, instance):
     #     if isinstance(instance, int) and instance > 0:
     #         return self._get_object(instance)
     #     return super().to_representation(instance)
 
     def to_internal_value(self, data):
-        if isinstance(data, int) and data > 0:
+        if _is_id(data):
             return self._get_object_by_id(data)
         return super().to_internal_value(data)
 
+    def _get_objects_by_ids(self, ids):
+        """
+        Returns a dict of id => instance.
+        All the missing ids are reported in a single validation error.
+        """
+        objects = self.model.objects.in_bulk(set(ids))
+        missing = [str(i) for i in dict.fromkeys(ids) if i not in objects]
+        if missing:
+            raise serializers.ValidationError(
+                "Could not find {} with ids {}".format(
+                    self.model.model_name_verbose, ", ".join(missing)
+                )
+            )
+        return objects
+
+    _is_lookup_value = staticmethod(_is_id)
+
+    def _get_objects(self, values):
+        return self._get_objects_by_ids(values)
+
     def _get_object_by_id(self, data_or_instance):
         try:
             return self.model.objects.get(id=data_or_instance)
@@ -82,21 +372,50 @@ class NameIdModelSerializer(NameModelSerializer, IdModelSerializer):
     """
 
     def to_internal_value(self, data):
-        instance = None
-        try:
-            instance = self._get_object_by_name(data_or_instance=data)
-        except self.model.DoesNotExist:
-            pass
-        try:
-            instance = self._get_object_by_id(data)
-        except self.model.DoesNotExist:
-            pass
-        if instance is None:
-            raise self.model.DoesNotExist(
+        if _is_name_or_id(data):
+            return self._get_objects_by_name_or_id([data])[data]
+        return super().to_internal_value(data)
+
+    _is_lookup_value = staticmethod(_is_name_or_id)
+
+    def _get_objects(self, values):
+        return self._get_objects_by_name_or_id(values)
+
+    def _get_objects_by_name_or_id(self, values):
+        """
+        Returns a dict of value => instance.
+
+        Strings are matched by name first and then by id if they are
+        numeric, integers are matched by id. Everything is looked up with a
+        single query, and the results are cached in the serializer context
+        so repeated values in the same request are not queried again.
+        """
+        cache = self.context.setdefault("_name_id_cache", {})
+        cache = cache.setdefault(self.model, {})
+        values = list(dict.fromkeys(values))
+        pending = [value for value in values if value not in cache]
+        if pending:
+            names = {value for value in pending if isinstance(value, str)}
+            ids = {_as_id(value) for value in pending} - {None}
+            by_name, by_id = {}, {}
+            for obj in self.model.objects.filter(Q(name__in=names) | Q(id__in=ids)):
+                by_name[obj.name] = obj
+                by_id[obj.id] = obj
+            for value in pending:
+                instance = by_name.get(value) if isinstance(value, str) else None
+                if instance is None:
+                    instance = by_id.get(_as_id(value))
+                if instance is not None:
+                    cache[value] = instance
+
+        missing = [str(value) for value in values if value not in cache]
+        if missing:
+            raise serializers.ValidationError(
                 "Could not find {} with name or id {}".format(
-                    self.model.model_name_verbose, data
+                    self.model.model_name_verbose, ", ".join(missing)
                 )
             )
+        return {value: cache[value] for value in values}
 
     def _get_object_by_name(self, data_or_instance):
         try:
@@ -110,7 +429,7 @@ class NameIdModelSerializer(NameModelSerializer, IdModelSerializer):
 
 
 class LocalTimeStampModelSerializer(BaseModelSerializer):
-    created = LocalTimeStampField()
-    modified = LocalTimeStampField()
+    created = LocalTimeStampField(local_source="created_local")
+    modified = LocalTimeStampField(local_source="modified_local")
     created_at = created
     modified_at = modified
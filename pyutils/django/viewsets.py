@@ -1,17 +1,150 @@
+from collections import OrderedDict
+from datetime import datetime
 from typing import Type
 
 import pendulum
 from deprecated import deprecated
+from django.core.exceptions import FieldDoesNotExist
+from django.utils import timezone
+from django.utils.functional import cached_property
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import mixins, permissions
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.filters import SearchFilter
+from rest_framework.relations import ManyRelatedField, RelatedField
+from rest_framework.response import Response
 from rest_framework.routers import SimpleRouter
+from rest_framework.serializers import BaseSerializer, ListSerializer
+from rest_framework.utils.urls import replace_query_param
 from rest_framework.viewsets import GenericViewSet
 
 from pyutils.django.models import BaseModel
+from pyutils.django.pagination import (
+    KeysetPagination,
+    pack_cursor,
+    seek_filter,
+    unpack_cursor,
+)
 from pyutils.string import pascal_case_to_dash_case
 
 
+# (viewset class, action) => {field name: (select_related, prefetch_related, only)}
+_field_plans = {}
+
+
+def _relation_path(model, source_attrs):
+    """
+    Follows `source_attrs` through the model relations.
+    Returns the relation attrs, the last model field and whether any of the
+    relations is to-many.
+    """
+    path, model_field, to_many = [], None, False
+    for attr in source_attrs:
+        try:
+            model_field = model._meta.get_field(attr)
+        except FieldDoesNotExist:
+            break
+        if not model_field.is_relation or model_field.related_model is None:
+            break
+        path.append(attr)
+        to_many = to_many or model_field.many_to_many or model_field.one_to_many
+        model = model_field.related_model
+    else:
+        return path, model_field, to_many
+    return path, None, to_many
+
+
+def field_lookups(model, field):
+    """
+    Returns the `select_related` and `prefetch_related` lookups needed by a
+    serializer field of `model`, see `related_lookups`.
+    """
+    if field.write_only or not field.source_attrs:
+        return [], []
+    path, last_field, to_many = _relation_path(model, field.source_attrs)
+    if not path:
+        return [], []
+    nested = field.child if isinstance(field, ListSerializer) else field
+    nested_select, nested_prefetch = [], []
+    if isinstance(nested, BaseSerializer):
+        if last_field is not None:
+            nested_select, nested_prefetch = related_lookups(nested)
+    else:
+        relation = field
+        if isinstance(field, ManyRelatedField):
+            relation = field.child_relation
+        if (
+            isinstance(relation, RelatedField)
+            and relation.use_pk_only_optimization()
+            and not to_many
+            and last_field is not None
+            and last_field.concrete
+        ):
+            # the pk is read from `<fk>_id` on the related instance
+            path = path[:-1]
+            if not path:
+                return [], []
+
+    select, prefetch = [], []
+    lookup = "__".join(path)
+    if to_many:
+        prefetch.append(lookup)
+        prefetch.extend("{}__{}".format(lookup, x) for x in nested_select)
+    else:
+        select.append(lookup)
+        select.extend("{}__{}".format(lookup, x) for x in nested_select)
+    prefetch.extend("{}__{}".format(lookup, x) for x in nested_prefetch)
+    return select, prefetch
+
+
+def related_lookups(serializer):
+    """
+    Returns the `select_related` and `prefetch_related` lookups needed to
+    serialize the instances of `serializer.Meta.model` without extra queries
+    per row, derived from the readable fields:
+
+    - dotted sources and nested serializers on to-one relations are joined
+    - to-many relations (`many=True` fields) are prefetched, including
+      whatever their nested serializer needs
+    - pk-only related fields read `<fk>_id` and need nothing
+    """
+    if isinstance(serializer, ListSerializer):
+        serializer = serializer.child
+    model = getattr(getattr(serializer, "Meta", None), "model", None)
+    if model is None:
+        return [], []
+
+    select, prefetch = [], []
+    for field in serializer.fields.values():
+        field_select, field_prefetch = field_lookups(model, field)
+        select.extend(field_select)
+        prefetch.extend(field_prefetch)
+    return list(dict.fromkeys(select)), list(dict.fromkeys(prefetch))
+
+
+def field_only(model, field):
+    """
+    Returns the model fields read by a serializer field of `model`, for
+    `.only()`, or None when it is not backed by a model field.
+    """
+    if field.write_only:
+        return []
+    if not field.source_attrs:
+        return None
+    try:
+        model_field = model._meta.get_field(field.source_attrs[0])
+    except FieldDoesNotExist:
+        return None
+    if model_field.many_to_many or model_field.one_to_many:
+        return []
+    if model_field.one_to_one and not model_field.concrete:
+        return []
+    if not model_field.concrete:
+        return None
+    return [model_field.name]
+
+
 class GenericModelViewSet(GenericViewSet):
     """
     A subclass of `GenericViewSet` with some additional `Model` specific
@@ -25,6 +158,14 @@ class GenericModelViewSet(GenericViewSet):
     filter_backends = [DjangoFilterBackend, SearchFilter]
     permission_classes = (permissions.IsAuthenticated,)
 
+    # lookups applied in `get_queryset`, derived from the serializer if None
+    select_related_fields = None
+    prefetch_related_fields = None
+
+    # sparse fieldsets, eg `?fields=id,name` or `?omit=description`
+    fields_query_param = "fields"
+    omit_query_param = "omit"
+
     @classmethod
     def model(cls) -> BaseModel:
         """
@@ -76,6 +217,129 @@ class GenericModelViewSet(GenericViewSet):
         except (KeyError, AttributeError):
             return super().get_serializer_class()
 
+    def get_serializer(self, *args, **kwargs):
+        serializer = super().get_serializer(*args, **kwargs)
+        if self.sparse_fields is not None:
+            target = serializer
+            if isinstance(serializer, ListSerializer):
+                target = serializer.child
+            for name in list(target.fields):
+                if name not in self.sparse_fields:
+                    target.fields.pop(name)
+        return serializer
+
+    @cached_property
+    def sparse_fields(self):
+        """
+        The serializer fields kept by `?fields=` / `?omit=` as a frozenset,
+        or None when neither is given. Only applies to safe methods, unknown
+        field names are ignored.
+        """
+        request = getattr(self, "request", None)
+        if request is None or request.method not in permissions.SAFE_METHODS:
+            return None
+        fields = request.query_params.get(self.fields_query_param)
+        omit = request.query_params.get(self.omit_query_param)
+        if not fields and not omit:
+            return None
+
+        names = frozenset(self.get_field_plans())
+        if fields:
+            names = names.intersection(x.strip() for x in fields.split(","))
+        if omit:
+            names = names.difference(x.strip() for x in omit.split(","))
+        return names
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action == "destroy":
+            return queryset
+        select, prefetch = self.get_queryset_plan()
+        if select:
+            queryset = queryset.select_related(*select)
+        if prefetch:
+            queryset = queryset.prefetch_related(*prefetch)
+        only = self.get_only_fields()
+        if only is not None:
+            queryset = queryset.only(*only)
+        return queryset
+
+    def get_field_plans(self):
+        """
+        Returns `{field name: (select_related, prefetch_related, only)}` for
+        the fields of the action's serializer, see `field_lookups` and
+        `field_only`. Cached per viewset and action, so a sparse fieldset
+        only combines the plans of its fields. Empty when the action has no
+        serializer.
+        """
+        key = (type(self), self.action)
+        plans = _field_plans.get(key)
+        if plans is None:
+            try:
+                serializer = self.get_serializer_class()(
+                    context=self.get_serializer_context()
+                )
+            except AssertionError:
+                # no `serializer_class` for this action, eg a custom action
+                serializer = None
+            plans = {}
+            if serializer is not None:
+                model = getattr(getattr(serializer, "Meta", None), "model", None)
+                for name, field in serializer.fields.items():
+                    if model is None:
+                        plans[name] = ([], [], None)
+                    else:
+                        plans[name] = (
+                            *field_lookups(model, field),
+                            field_only(model, field),
+                        )
+            _field_plans[key] = plans
+        return plans
+
+    def _kept_field_plans(self):
+        plans = self.get_field_plans()
+        if self.sparse_fields is None:
+            return list(plans.values())
+        return [plan for name, plan in plans.items() if name in self.sparse_fields]
+
+    def get_queryset_plan(self):
+        """
+        Returns the `select_related` and `prefetch_related` lookups for the
+        current action.
+
+        `select_related_fields` / `prefetch_related_fields` are used when
+        set, otherwise they are derived from the serializer fields kept by
+        the sparse fieldset (all of them by default).
+        """
+        select, prefetch = self.select_related_fields, self.prefetch_related_fields
+        if select is None or prefetch is None:
+            kept = self._kept_field_plans()
+            if select is None:
+                select = dict.fromkeys(x for plan in kept for x in plan[0])
+            if prefetch is None:
+                prefetch = dict.fromkeys(x for plan in kept for x in plan[1])
+        return list(select), list(prefetch)
+
+    def get_only_fields(self):
+        """
+        Returns the fields for `.only()` when a sparse fieldset is requested,
+        else None. The fields joined with `select_related` and the keyset
+        pagination column are included.
+        """
+        if self.sparse_fields is None:
+            return None
+        only = []
+        for _, _, field_names in self._kept_field_plans():
+            if field_names is None:
+                return None
+            only.extend(field_names)
+        select, _ = self.get_queryset_plan()
+        only.extend(lookup.split("__")[0] for lookup in select)
+        if isinstance(self.paginator, KeysetPagination):
+            # read by the cursor
+            only.append(self.paginator.ordering.lstrip("-"))
+        return list(dict.fromkeys(only))
+
 
 class TimeStampedListModelMixin(mixins.ListModelMixin):
     def list(self, request, *args, **kwargs):
@@ -95,6 +359,117 @@ class TimeStampedListModelMixin(mixins.ListModelMixin):
         parse("created_date_gte")
 
 
+class DeltaFeedMixin:
+    """
+    Adds a `changes` list route that returns only the rows modified after
+    `?modified_since=<datetime>`, for clients that sync incrementally.
+
+    Rows are read in `(modified, id)` order using the index on `modified`,
+    `delta_page_size` at a time. While `next` is set the client follows it;
+    on the last page `high_water_mark` is returned, which is the
+    `modified_since` to send on the next sync. Without `modified_since` all
+    rows are returned (initial sync).
+
+    Deletes are reported in `deleted` (first page only) by overriding
+    `get_deleted_ids`, eg from a tombstone table:
+
+        def get_deleted_ids(self, since, until):
+            return Tombstone.objects.filter(
+                model="item", deleted__gt=since, deleted__lte=until
+            ).values_list("object_id", flat=True)
+    """
+
+    delta_field = "modified"
+    delta_page_size = 500
+    modified_since_query_param = "modified_since"
+    delta_cursor_query_param = "cursor"
+    invalid_delta_cursor_message = "Invalid cursor"
+
+    @action(detail=False, methods=["get"])
+    def changes(self, request, *args, **kwargs):
+        field = self.delta_field
+        since = self.get_modified_since(request)
+        cursor = self._decode_delta_cursor(request)
+        # `until` is fixed on the first page so that rows modified while the
+        # client is paging are left for the next sync instead of being skipped
+        until = cursor["u"] if cursor else timezone.now()
+
+        queryset = self.filter_queryset(self.get_queryset())
+        queryset = queryset.filter(**{f"{field}__lte": until})
+        if since is not None:
+            queryset = queryset.filter(**{f"{field}__gt": since})
+        if cursor:
+            queryset = queryset.filter(
+                seek_filter(field, cursor["v"], cursor["id"], "gt")
+            )
+        rows = list(queryset.order_by(field, "id")[: self.delta_page_size + 1])
+        has_more = len(rows) > self.delta_page_size
+        rows = rows[: self.delta_page_size]
+
+        deleted = []
+        if cursor is None and since is not None:
+            deleted = list(self.get_deleted_ids(since, until))
+        next_link = None
+        if has_more:
+            next_link = self._encode_delta_cursor(request, rows[-1], until)
+        return Response(
+            OrderedDict(
+                [
+                    ("next", next_link),
+                    ("high_water_mark", None if has_more else until.isoformat()),
+                    ("deleted", deleted),
+                    ("results", self.get_serializer(rows, many=True).data),
+                ]
+            )
+        )
+
+    def get_only_fields(self):
+        only = super().get_only_fields()
+        if only is not None and self.action == "changes":
+            # read by the cursor
+            only = only + [self.delta_field]
+        return only
+
+    def get_modified_since(self, request):
+        value = request.query_params.get(self.modified_since_query_param)
+        if not value:
+            return None
+        try:
+            dt = pendulum.parse(value)
+        except ValueError:
+            dt = None
+        if not isinstance(dt, datetime):
+            raise ValidationError(
+                {self.modified_since_query_param: "Invalid datetime: {}".format(value)}
+            )
+        return dt
+
+    def get_deleted_ids(self, since, until):
+        """
+        Override to return the ids deleted in `(since, until]`.
+        """
+        return []
+
+    def _decode_delta_cursor(self, request):
+        encoded = request.query_params.get(self.delta_cursor_query_param)
+        if encoded is None:
+            return None
+        field = self.model()._meta.get_field(self.delta_field)
+        return unpack_cursor(
+            encoded,
+            {"v": field.to_python, "id": int, "u": field.to_python},
+            self.invalid_delta_cursor_message,
+        )
+
+    def _encode_delta_cursor(self, request, obj, until):
+        cursor = {"v": getattr(obj, self.delta_field), "id": obj.id, "u": until}
+        return replace_query_param(
+            request.build_absolute_uri(),
+            self.delta_cursor_query_param,
+            pack_cursor(cursor),
+        )
+
+
 BaseModelViewSet = GenericModelViewSet
 
 
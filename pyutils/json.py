@@ -0,0 +1,214 @@
+"""
+Streaming JSON utils
+"""
+import codecs
+import json
+import re
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+_STRUCTURE = re.compile(r'["{}\[\]]')
+_STRING_END = re.compile(r'["\\]')
+# characters that can continue a number, eg `1.` + `5`
+_NUMBER_CHARS = frozenset("0123456789+-.eE")
+
+
+def parse_simple_json_path(json_path: str):
+    """
+    Keys of a simple JSON path.
+    `$.data.items[*]` => ["data", "items"]
+    `$` => []
+    """
+    path = json_path.strip()
+    if path.endswith("[*]"):
+        path = path[:-3]
+    if path != "$" and not path.startswith("$."):
+        raise ValueError("Unsupported JSON path for streaming: {}".format(json_path))
+    keys = path.split(".")[1:]
+    if any(not key or "[" in key or "*" in key for key in keys):
+        raise ValueError("Unsupported JSON path for streaming: {}".format(json_path))
+    return keys
+
+
+def iter_json_array(stream, json_path: str = "$", chunk_size: int = 64 * 1024):
+    """
+    Yield the items of the array at `json_path` without loading the whole
+    document. Only the current item (and the chunk being read) is held in
+    memory.
+
+    Args:
+        stream: A file object (text or binary) or an iterable of bytes/str chunks
+        json_path: A simple path of object keys to the array, eg `$.data.items`
+            (a trailing `[*]` is also accepted)
+        chunk_size: Number of bytes/characters read from a file object at a time
+    """
+    reader = JsonStreamReader(stream, chunk_size)
+    for key in parse_simple_json_path(json_path):
+        if not reader.seek_key(key):
+            raise ValueError("{} not found in the JSON document".format(json_path))
+    yield from reader.iter_array()
+
+
+class JsonStreamReader:
+    """
+    Incremental reader over a JSON document.
+    """
+
+    def __init__(self, stream, chunk_size: int = 64 * 1024):
+        if hasattr(stream, "read"):
+            self._chunks = self._read_chunks(stream, chunk_size)
+        else:
+            self._chunks = iter(stream)
+        self._bytes_decoder = codecs.getincrementaldecoder("utf-8-sig")()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    @staticmethod
+    def _read_chunks(stream, chunk_size):
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def _fill(self):
+        """
+        Append the next chunk to the buffer, dropping what has been consumed.
+        Returns False at the end of the stream.
+        """
+        if self.eof:
+            return False
+        self.buffer = self.buffer[self.pos :]
+        self.pos = 0
+        for chunk in self._chunks:
+            if isinstance(chunk, bytes):
+                chunk = self._bytes_decoder.decode(chunk)
+            if chunk:
+                self.buffer += chunk
+                return True
+        self.eof = True
+        tail = self._bytes_decoder.decode(b"", final=True)
+        self.buffer += tail
+        return bool(tail)
+
+    def _next_char(self):
+        """
+        Skip whitespace and return the next character ("" at the end).
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ""
+
+    def _expect(self, char):
+        found = self._next_char()
+        if found != char:
+            raise ValueError("Expected {!r} but found {!r}".format(char, found))
+        self.pos += 1
+
+    def _end_of(self, opening, closing):
+        """
+        After an item: consume `,` and return False, or `closing` and return True.
+        """
+        char = self._next_char()
+        self.pos += 1
+        if char == ",":
+            return False
+        if char == closing:
+            return True
+        raise ValueError("Malformed JSON {}: found {!r}".format(opening, char))
+
+    def decode(self):
+        """
+        Decode the next JSON value.
+        """
+        self._next_char()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise
+            # a value at the end of the buffer, or a number cut after `.` or
+            # `e`, may continue in the next chunk
+            if (
+                end == len(self.buffer)
+                or (
+                    self.buffer[self.pos] in _NUMBER_CHARS
+                    and self.buffer[end] in _NUMBER_CHARS
+                )
+            ) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def skip(self):
+        """
+        Skip the next JSON value without decoding nested containers.
+        """
+        if self._next_char() not in "{[":
+            self.decode()
+            return
+        depth = 0
+        in_string = False
+        while True:
+            pattern = _STRING_END if in_string else _STRUCTURE
+            match = pattern.search(self.buffer, self.pos)
+            if match is None:
+                self.pos = len(self.buffer)
+                if not self._fill():
+                    raise ValueError("Unexpected end of JSON document")
+                continue
+            char = match.group()
+            self.pos = match.end()
+            if in_string:
+                if char == "\\":
+                    if self.pos >= len(self.buffer) and not self._fill():
+                        raise ValueError("Unexpected end of JSON document")
+                    self.pos += 1
+                else:
+                    in_string = False
+            elif char == '"':
+                in_string = True
+            elif char in "{[":
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return
+
+    def seek_key(self, key: str):
+        """
+        Move into the value of `key` of the next object.
+        Returns False if the object does not have the key.
+        """
+        self._expect("{")
+        if self._next_char() == "}":
+            self.pos += 1
+            return False
+        while True:
+            name = self.decode()
+            self._expect(":")
+            if name == key:
+                return True
+            self.skip()
+            if self._end_of("object", "}"):
+                return False
+
+    def iter_array(self):
+        """
+        Yield the items of the next array.
+        """
+        self._expect("[")
+        if self._next_char() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.decode()
+            if self._end_of("array", "]"):
+                return